@@ -1,66 +1,148 @@
 import os
+import asyncio
+import atexit
+import json
+import logging
+import queue
+import re
 import random
 import time
-import subprocess
-import sys
-from typing import Optional, Dict
+import threading
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional, Dict, List
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth1Session
-import logging
-from notdiamond import NotDiamond
-
-# Load environment variables from repository secrets
-nd_api_key = os.getenv("NOT_DIAMOND_API_KEY")
-access_token = os.getenv("ACCESS_TOKEN")
-access_token_secret = os.getenv("ACCESS_TOKEN_SECRET")
-consumer_key = os.getenv("CONSUMER_KEY")
-consumer_secret = os.getenv("CONSUMER_SECRET")
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('twitter_bot.log'),
-        logging.StreamHandler()
-    ]
-)
+from urllib3.util.retry import Retry
+
 logger = logging.getLogger(__name__)
 
-class ModuleInstaller:
-    @staticmethod
-    def install_requirements():
-        """Install required Python modules."""
-        required_modules = [
-            'requests-oauthlib',
-            'notdiamond',
-            'requests'
-        ]
-        
-        for module in required_modules:
-            try:
-                subprocess.check_call([
-                    sys.executable, 
-                    '-m', 
-                    'pip', 
-                    'install', 
-                    '--upgrade',
-                    module
-                ])
-                logger.info(f"Successfully installed {module}")
-            except subprocess.CalledProcessError as e:
-                logger.error(f"Failed to install {module}: {str(e)}")
-                raise
+def configure_logging() -> None:
+    """Configure console and file logging, writing records from a background thread."""
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler = RotatingFileHandler('twitter_bot.log', maxBytes=5_000_000, backupCount=3, delay=True)
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    # Batch file writes in memory, flushing on errors or once 200 records pile up
+    buffered_file_handler = MemoryHandler(capacity=200, flushLevel=logging.ERROR, target=file_handler)
+
+    # The calling thread only enqueues records; the listener does the I/O
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, buffered_file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+
+    def shutdown() -> None:
+        listener.stop()
+        buffered_file_handler.close()  # Flushes any buffered records
+        file_handler.close()
+
+    atexit.register(shutdown)
+
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+
+# Fixed system message sent first on every call, with the varying request last.
+# Note: this prefix is far below the 1024 tokens OpenAI needs before it caches
+# a prompt, and Not Diamond sends no Anthropic cache_control, so no provider
+# caches it; the split is kept only as the message layout.
+SYSTEM_PROMPT = (
+    "You are a helpful assistant. Reply with the requested number of tweets, "
+    "one per line and nothing else: no preamble, numbering, bullets or quotes. "
+    "Each tweet must be complete on its own line, end with a full sentence and "
+    "stay under 250 characters."
+)
+
+class TokenBucketLimiter:
+    """Thread-safe token bucket allowing short bursts within a sustained request rate."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate  # Tokens added per second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Take one token, sleeping until one is available."""
+        # Waiting while holding the lock keeps queued callers spaced out
+        # instead of all firing together once the bucket refills.
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.tokens = 1.0
+                self.updated = time.monotonic()
+
+            self.tokens -= 1
+
+class CircuitBreaker:
+    """Stops calls to a failing service until it has had time to recover."""
+
+    def __init__(self, fail_threshold: int, reset_timeout: float):
+        self.fail_threshold = fail_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        """Whether calls should be skipped; after the timeout, one more failure reopens it."""
+        return time.monotonic() < self.opened_until
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_until = 0.0
+
+    def record_failure(self, retry_after: Optional[float] = None) -> None:
+        """Count a failure, opening the circuit at the threshold or for an explicit retry_after."""
+        with self._lock:
+            self.failures += 1
+            if retry_after is not None:
+                self.opened_until = time.monotonic() + retry_after
+            elif self.failures >= self.fail_threshold:
+                self.opened_until = time.monotonic() + self.reset_timeout
 
 class TwitterBot:
+    USER_AGENT = 'InvisibleAI-TwitterBot/1.0'
+    _WS_RE = re.compile(r'\s+')
+    _BULLET_RE = re.compile(r'^\s*(?:\d+[.)]|[-*])\s+')
+    _QUOTES = '"\u201c\u201d'
+    PROMPTS = (
+        "Concisely explain merge sort.",  # Adjust as needed
+    )
+
     def __init__(self):
         """Initialize Twitter bot and load credentials."""
         self.credentials = self._load_credentials()
         self.auth = self._initialize_twitter_auth()
+        self._post = self.auth.post
+        # Imported here so a run with missing credentials exits before loading it
+        from notdiamond import NotDiamond
         self.client = NotDiamond()  # Initialize NotDiamond client
         self.API_URL_POST = 'https://api.twitter.com/2/tweets'
         self.MAX_TWEET_LENGTH = 280
-        self.RATE_LIMIT_DELAY = 60  # Time to wait between tweets
-        self.last_tweet_time = None
+        self._limit = self.MAX_TWEET_LENGTH - 6  # Longest tweet kept as is
+        self._cap = self.MAX_TWEET_LENGTH - 9  # Truncated length before the ellipsis
+        self.MAX_OUTPUT_TOKENS = 60  # Roughly one tweet's worth of tokens
+        self.TEMPERATURE = None  # None keeps each provider's default
+        self.limiter = TokenBucketLimiter(rate=300 / 10800, burst=5)  # Twitter's 300 tweets per 3 hours
+        self._breaker = CircuitBreaker(fail_threshold=2, reset_timeout=300)  # Trips on 429/5xx
+        self.BATCH_SIZE = 3  # Tweets requested per LLM call
+        # Render every prompt's messages once; each call just indexes into the pool
+        self._message_pool = tuple(self._build_messages(prompt) for prompt in self.PROMPTS)
+        self.MODELS = self._build_models([
+            'openai/gpt-4o',
+            'openai/gpt-4o-mini',
+            'anthropic/claude-3-5-sonnet-20240620'
+        ])
+        self.content_rejected = False
         
     def _load_credentials(self) -> Dict[str, str]:
         """Load and validate Twitter API credentials from environment variables."""
@@ -85,96 +167,184 @@ class TwitterBot:
             
         return credentials
 
+    async def __aenter__(self) -> "TwitterBot":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close the pooled Twitter session."""
+        self.auth.close()
+
     def _initialize_twitter_auth(self) -> OAuth1Session:
-        """Initialize Twitter OAuth session."""
-        return OAuth1Session(
+        """Initialize Twitter OAuth session with a pooled keep-alive transport."""
+        session = OAuth1Session(
             client_key=self.credentials["CONSUMER_KEY"],
             client_secret=self.credentials["CONSUMER_SECRET"],
             resource_owner_key=self.credentials["ACCESS_TOKEN"],
             resource_owner_secret=self.credentials["ACCESS_TOKEN_SECRET"]
         )
 
-    def generate_tweet(self) -> Optional[str]:
-        """Generate tweet content using Not Diamond."""
+        # Reuse the TLS connection to api.twitter.com across tweets and retries.
+        # Only failed connects are retried: a POST that reached Twitter is never
+        # resent here, to avoid double-posting; 429/5xx go to the circuit breaker.
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=20,
+            max_retries=Retry(total=3, read=0)
+        )
+        session.mount('https://', adapter)
+        session.headers['User-Agent'] = self.USER_AGENT
+        session.headers['Content-Type'] = 'application/json'  # Payloads are pre-serialized
+        return session
+
+    def _build_models(self, names: List[str]) -> list:
+        """Build Not Diamond model configs carrying the generation settings."""
+        # Not Diamond passes create()/acreate() kwargs to the prompt template, not
+        # the model (the async path drops them), so settings travel on each LLMConfig.
+        from notdiamond.llms.config import LLMConfig
+
+        settings = {"max_tokens": self.MAX_OUTPUT_TOKENS * self.BATCH_SIZE}
+        if self.TEMPERATURE is not None:
+            settings["temperature"] = self.TEMPERATURE
+
+        models = []
+        for name in names:
+            provider, model = name.split('/', 1)
+            models.append(LLMConfig(provider=provider, model=model, **settings))
+        return models
+
+    def _build_messages(self, prompt: str) -> List[Dict[str, str]]:
+        """Build the chat messages asking for BATCH_SIZE tweets about a prompt."""
+        # Static system prompt first, the per-prompt request last
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"{prompt} Write {self.BATCH_SIZE} different tweets, one per line."}
+        ]
+
+    async def _generate_batch(self, index: int) -> List[str]:
+        """Generate BATCH_SIZE tweets for one pooled prompt in a single Not Diamond call."""
         try:
-            # Define the chat message to send to Not Diamond
-            messages = [
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": "Concisely explain merge sort."}  # Adjust as needed
-            ]
-            
             # Call Not Diamond to get the best LLM response
-            result, session_id, provider = self.client.chat.completions.create(
-                messages=messages,
-                model=[
-                    'openai/gpt-4o',
-                    'openai/gpt-4o-mini',
-                    'anthropic/claude-3-5-sonnet-20240620'
-                ]
+            result, session_id, provider = await self.client.chat.completions.acreate(
+                messages=self._message_pool[index],
+                model=self.MODELS
             )
 
             content = result.content.strip()  # Get the response content
-            logger.info(f"Generated tweet content: {content} using model: {provider.model}")
+            logger.info("Generated tweet content: %s using model: %s", content, provider.model)
 
-            # Format and clean content
-            content = self._format_content(content)
-            return content
+            return self._split_tweets(content)
             
         except Exception as e:
-            logger.error(f"Error generating tweet content: {str(e)}", exc_info=True)
-            return None
+            logger.error("Error generating tweet content: %s", e, exc_info=True)
+            return []
+
+    def _split_tweets(self, content: str) -> List[str]:
+        """Split a multi-tweet response into at most BATCH_SIZE cleaned tweets."""
+        tweets = []
+        for line in content.splitlines():
+            # Models occasionally number or bullet the lines despite the prompt
+            line = self._BULLET_RE.sub('', line).strip()
+
+            # ...and wrap them in quotes
+            if len(line) > 1 and line[0] in self._QUOTES and line[-1] in self._QUOTES:
+                line = line[1:-1].strip()
+
+            # Skip preambles ("Here are three tweets:") and lines cut off by the token cap
+            if not line.endswith(('.', '!', '?')):
+                continue
+
+            # Format and clean content
+            tweets.append(self._format_content(line))
+            if len(tweets) == self.BATCH_SIZE:
+                break
+        return tweets
 
     def _format_content(self, content: str) -> str:
         """Format and clean tweet content."""
-        content = ' '.join(content.split())
-        
-        if len(content) > self.MAX_TWEET_LENGTH - 6:
-            content = content[:self.MAX_TWEET_LENGTH - 9] + "..."
-            
-        return content
+        content = self._WS_RE.sub(' ', content.strip())
+        return content if len(content) <= self._limit else f"{content[:self._cap]}..."
 
-    def post_tweet(self, content: str) -> bool:
+    async def post_tweet(self, content: str) -> bool:
         """Post tweet with error handling."""
+        self.content_rejected = False
+        if self._breaker.is_open:
+            logger.warning("Twitter circuit breaker is open, skipping post")
+            return False
+
         try:
-            if self.last_tweet_time:
-                elapsed = time.time() - self.last_tweet_time
-                if elapsed < self.RATE_LIMIT_DELAY:
-                    time.sleep(self.RATE_LIMIT_DELAY - elapsed)
+            await asyncio.to_thread(self.limiter.acquire)
             
-            payload = {"text": content}
-            response = self.auth.post(self.API_URL_POST, json=payload)
+            # OAuth1 signing lives in requests_oauthlib, so the pooled session runs in a worker thread
+            payload = json.dumps({"text": content}, separators=(',', ':')).encode()
+            try:
+                response = await asyncio.to_thread(self._post, self.API_URL_POST, data=payload)
+            except Exception:
+                self._breaker.record_failure()
+                raise
+
+            if response.status_code == 429:
+                self._breaker.record_failure(retry_after=self._retry_after(response))
+            elif response.status_code >= 500:
+                self._breaker.record_failure()
+            else:
+                self._breaker.record_success()
+
+            # 400/403 mean Twitter refused this text (invalid or duplicate)
+            self.content_rejected = response.status_code in (400, 403)
             response.raise_for_status()
             
-            self.last_tweet_time = time.time()
             logger.info("Tweet posted successfully")
             return True
             
         except Exception as e:
-            logger.error(f"Error posting tweet: {str(e)}", exc_info=True)
+            logger.error("Error posting tweet: %s", e, exc_info=True)
             return False
 
-    def run(self, retries: int = 3) -> bool:
+    @staticmethod
+    def _retry_after(response, default: int = 60) -> int:
+        """Seconds to wait before retrying, from the Retry-After header when it is numeric."""
+        try:
+            return int(response.headers.get("Retry-After", default))
+        except ValueError:
+            return default
+
+    async def run(self, retries: int = 3) -> bool:
         """Main execution flow with retry logic."""
+        content = None
+        candidates = []  # Unused tweets from the last batch, tried before generating again
         for attempt in range(retries):
             try:
-                logger.info(f"Tweet attempt {attempt + 1}/{retries}")
-                content = self.generate_tweet()
+                logger.info("Tweet attempt %d/%d", attempt + 1, retries)
+                # Only move on from the current tweet when there is none or Twitter rejected it
+                if not content or self.content_rejected:
+                    if not candidates:
+                        candidates = await self._generate_batch(random.randrange(len(self._message_pool)))
+                    content = candidates.pop(0) if candidates else None
                 
                 if content:
-                    if self.post_tweet(content):
+                    if await self.post_tweet(content):
                         return True
+
+                if self._breaker.is_open:
+                    logger.error("Twitter is unavailable, giving up until the next run")
+                    return False
                 
-                time.sleep(2)  # Short wait before retrying
+                await asyncio.sleep(2)  # Short wait before retrying
             except Exception as e:
-                logger.error(f"Unexpected error in run: {str(e)}", exc_info=True)
-                time.sleep(2)  # Short wait before retrying
+                logger.error("Unexpected error in run: %s", e, exc_info=True)
+                await asyncio.sleep(2)  # Short wait before retrying
         
         logger.error("Failed to post tweet after multiple attempts")
         return False
 
+async def main() -> bool:
+    async with TwitterBot() as bot:
+        return await bot.run()
+
 if __name__ == "__main__":
-    # Check if required modules are installed
-    ModuleInstaller.install_requirements()
+    configure_logging()
 
-    bot = TwitterBot()
-    bot.run()
+    asyncio.run(main())